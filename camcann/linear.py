@@ -4,11 +4,15 @@ from pathlib import Path
 from typing import Any, Dict, Optional, Union
 
 import numpy as np
+from scipy import sparse
+from scipy.linalg import eigh
+from sklearn.base import BaseEstimator, RegressorMixin
 from sklearn.feature_selection import SelectFromModel
-from sklearn.linear_model import BayesianRidge, ElasticNetCV, RidgeCV
+from sklearn.linear_model import BayesianRidge, ElasticNetCV, SGDRegressor
 from sklearn.metrics import mean_squared_error, r2_score
-from sklearn.pipeline import make_pipeline
+from sklearn.model_selection import KFold
 from sklearn.preprocessing import StandardScaler
+from sklearn.utils.extmath import safe_sparse_dot
 
 from .data.featurise.ecfp import SMILESHashes
 from .uq import nll
@@ -16,10 +20,199 @@ from .uq import nll
 def get_unnormed_contribs(
     coefs: np.ndarray, scaler: StandardScaler, selector: SelectFromModel
 ) -> np.ndarray:
-    """Get the contributions of the unnormalised subgraphs."""
-    scaled_ones = scaler.transform(np.ones((1, scaler.n_features_in_)))
-    scaled_ones = selector.transform(scaled_ones)
-    return coefs * scaled_ones
+    """Get the contributions of the unnormalised subgraphs.
+
+    The coefficients are weights on standardised features, not data points,
+    so mapping them back to raw fingerprint counts is a straight division by
+    the per-column scale factors; routing them through the scaler's
+    transform machinery would be wrong semantics and allocates a
+    feature-width buffer per call.
+    """
+    sel_idx = selector.get_support(indices=True)
+    return coefs / scaler.scale_[sel_idx]
+
+
+class EigenRidgeCV(BaseEstimator, RegressorMixin):
+    """Ridge regression with the alpha search done over one eigendecomposition.
+
+    ``RidgeCV`` solves a fresh linear system for every alpha in the grid.
+    After feature selection the number of features d is small relative to the
+    number of samples N, so the closed form
+    beta(alpha) = V (Gamma + alpha I)^-1 V^T X^T y
+    lets a single eigendecomposition of the centred Gram matrix X^T X serve
+    the whole grid: each alpha costs O(N d + d^2) after the one-off O(d^3)
+    decomposition. Alphas are scored by leave-one-out RMSE computed from the
+    hat-matrix diagonal, matching ``RidgeCV``'s default behaviour.
+
+    Args:
+        alphas: The grid of regularisation strengths to search over.
+
+    """
+
+    def __init__(self, alphas=(0.1, 1.0, 10.0)) -> None:
+        self.alphas = alphas
+
+    def fit(self, X, y) -> "EigenRidgeCV":
+        """Fit the model, selecting the best alpha by leave-one-out RMSE."""
+        alphas = np.asarray(self.alphas)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        n_samples = X.shape[0]
+
+        x_mean = np.asarray(X.mean(axis=0)).ravel()
+        y_mean = y.mean()
+
+        # Gram matrix and moment vector of the implicitly centred design.
+        gram = safe_sparse_dot(X.T, X, dense_output=True)
+        gram -= n_samples * np.outer(x_mean, x_mean)
+        xty = safe_sparse_dot(X.T, y, dense_output=True) - n_samples * x_mean * y_mean
+
+        gammas, eigvecs = eigh(gram)
+        gammas = np.clip(gammas, 0.0, None)
+        vt_xty = eigvecs.T @ xty
+
+        # Per-sample projections onto the eigenbasis, reused for the hat
+        # diagonal and the training residuals at every alpha.
+        proj = safe_sparse_dot(X, eigvecs, dense_output=True) - x_mean @ eigvecs
+        proj_sq = proj**2
+        y_centred = y - y_mean
+
+        best_rmse = np.inf
+        for alpha in alphas:
+            shrink = gammas + alpha
+            resids = y_centred - proj @ (vt_xty / shrink)
+            hat_diag = 1 / n_samples + proj_sq @ (1 / shrink)
+            loo_resids = resids / (1 - hat_diag)
+            rmse = np.sqrt(np.mean(loo_resids**2))
+            if rmse < best_rmse:
+                best_rmse = rmse
+                self.alpha_ = alpha
+
+        self.coef_ = eigvecs @ (vt_xty / (gammas + self.alpha_))
+        self.intercept_ = y_mean - x_mean @ self.coef_
+        self.best_score_ = -best_rmse
+        return self
+
+    def predict(self, X) -> np.ndarray:
+        """Get an array of predictions."""
+        return safe_sparse_dot(X, self.coef_, dense_output=True) + self.intercept_
+
+
+class SGDElasticNetCV(BaseEstimator, RegressorMixin):
+    """Elastic net CV fitted with SGD instead of coordinate descent.
+
+    Coordinate descent sweeps every fingerprint column per pass, costing
+    O(N D) however sparse the matrix is; SGD updates cost O(nnz)
+    per epoch, which is far cheaper on wide, sparse ECFP designs. The CSR
+    matrix is fed to the solver directly, never densified. Within each fold
+    the solver is warm-started down the (descending) alpha grid. Exposes
+    ``alpha_``, ``l1_ratio_``, ``coef_`` and ``intercept_`` so it can stand
+    in for ``ElasticNetCV`` in the feature selection step.
+
+    Args:
+        l1_ratio: The L1 ratios to search over.
+        alphas: The grid of regularisation strengths.
+        cv: Number of cross-validation folds.
+        random_state: Seed for the fold shuffling and the SGD updates.
+
+    """
+
+    def __init__(
+        self,
+        l1_ratio=(0.1, 0.5, 0.7, 0.9, 0.95, 0.99, 1),
+        alphas=tuple(np.logspace(-5, -1, 10)),
+        cv=5,
+        random_state=0,
+    ) -> None:
+        self.l1_ratio = l1_ratio
+        self.alphas = alphas
+        self.cv = cv
+        self.random_state = random_state
+
+    def _make_sgd(self, l1_ratio: float) -> SGDRegressor:
+        # No iterate averaging: the averaged coefficients almost never hit
+        # exact zero, which would defeat the downstream SelectFromModel
+        # threshold; plain truncated-gradient L1 updates do produce zeros.
+        return SGDRegressor(
+            penalty="elasticnet",
+            l1_ratio=l1_ratio,
+            learning_rate="adaptive",
+            warm_start=True,
+            random_state=self.random_state,
+        )
+
+    def fit(self, X, y) -> "SGDElasticNetCV":
+        """Fit the model, searching the (l1_ratio, alpha) grid by K-fold CV."""
+        y = np.asarray(y, dtype=np.float64).ravel()
+        alphas = np.sort(np.asarray(self.alphas))[::-1]
+        folds = KFold(self.cv, shuffle=True, random_state=self.random_state)
+
+        self.mse_path_ = np.empty((len(self.l1_ratio), alphas.size, self.cv))
+        for i, l1_ratio in enumerate(self.l1_ratio):
+            for k, (train_idx, val_idx) in enumerate(folds.split(X)):
+                sgd = self._make_sgd(l1_ratio)
+                X_train, y_train = X[train_idx], y[train_idx]
+                X_val, y_val = X[val_idx], y[val_idx]
+                for j, alpha in enumerate(alphas):
+                    sgd.set_params(alpha=alpha)
+                    sgd.fit(X_train, y_train)
+                    self.mse_path_[i, j, k] = mean_squared_error(
+                        y_val, sgd.predict(X_val)
+                    )
+
+        best_i, best_j = np.unravel_index(
+            np.argmin(self.mse_path_.mean(axis=-1)), self.mse_path_.shape[:2]
+        )
+        self.l1_ratio_ = self.l1_ratio[best_i]
+        self.alpha_ = alphas[best_j]
+
+        final = self._make_sgd(self.l1_ratio_)
+        final.set_params(alpha=self.alpha_, warm_start=False)
+        final.fit(X, y)
+        self.coef_ = final.coef_
+        self.intercept_ = final.intercept_[0]
+        return self
+
+    def predict(self, X) -> np.ndarray:
+        """Get an array of predictions."""
+        return safe_sparse_dot(X, self.coef_, dense_output=True) + self.intercept_
+
+
+class FastPredictor:
+    """Single-precision inference path for a fitted linear model.
+
+    Fingerprint counts span well under eight bits of dynamic range, so
+    float32 weights and scale factors halve the memory traffic of the
+    (memory-bound) prediction dot product without affecting accuracy.
+
+    Args:
+        coef: The fitted linear weights over the selected columns.
+        intercept: The fitted intercept.
+        inv_scale: Reciprocal of the scaler's scale factors for the
+            selected columns.
+        sel_idx: Integer indices of the selected fingerprint columns.
+
+    """
+
+    def __init__(
+        self,
+        coef: np.ndarray,
+        intercept: float,
+        inv_scale: np.ndarray,
+        sel_idx: np.ndarray,
+    ) -> None:
+        self.coef = np.asarray(coef, dtype=np.float32).ravel()
+        self.intercept = np.float32(intercept)
+        self.inv_scale = np.asarray(inv_scale, dtype=np.float32)
+        self.sel_idx = sel_idx
+
+    def predict(self, fps: Union[np.ndarray, sparse.spmatrix]) -> np.ndarray:
+        """Get an array of predictions in single precision."""
+        selected = fps[:, self.sel_idx].astype(np.float32)
+        if sparse.issparse(selected):
+            scaled = selected.multiply(self.inv_scale).tocsr()
+        else:
+            scaled = selected * self.inv_scale
+        return safe_sparse_dot(scaled, self.coef, dense_output=True) + self.intercept
 
 
 @dataclass
@@ -69,21 +262,48 @@ class LinearECFPModel:
     def __init__(
         self,
         smiles_hashes: SMILESHashes,
-        train_fps: np.ndarray,
+        train_fps: Union[np.ndarray, sparse.spmatrix],
         train_targets: np.ndarray,
-        test_fps: np.ndarray,
+        test_fps: Union[np.ndarray, sparse.spmatrix],
         test_targets: np.ndarray,
+        sgd_feature_select: bool = False,
     ) -> None:
         """Initialize smiles hash dataframe."""
         self.smiles_hashes = smiles_hashes
-        self.train_fps = train_fps
+        # ECFP vectors are overwhelmingly zero, so keep them in CSR form:
+        # the scaler, elastic net and ridge steps all accept sparse input.
+        self.train_fps = sparse.csr_matrix(train_fps)
         self.train_targets = train_targets
-        self.test_fps = test_fps
+        self.test_fps = sparse.csr_matrix(test_fps)
         self.test_targets = test_targets
 
-        self.scaler = StandardScaler()
-        self.fs_encv = ElasticNetCV(l1_ratio=[0.1, 0.5, 0.7, 0.9, 0.95, 0.99, 1])
-        self.final_ridge = RidgeCV(np.linspace(0.1, 10, 100))
+        # Centring would densify the fingerprints, so only scale. The scaled
+        # matrix is kept in train_scaled, so no defensive copy is needed.
+        self.scaler = StandardScaler(with_mean=False, copy=False)
+        if sgd_feature_select:
+            # SGD is cheaper per epoch than coordinate descent on
+            # very wide sparse designs.
+            self.fs_encv = SGDElasticNetCV(
+                l1_ratio=(0.1, 0.5, 0.7, 0.9, 0.95, 0.99, 1), random_state=0
+            )
+        else:
+            # The fingerprints stay sparse through the scaler, so the Gram
+            # matrix cannot be cached without densifying; random coordinate
+            # selection converges faster on the highly correlated fingerprint
+            # columns. Because the matrix is never centred (the intercept is
+            # handled by offset arithmetic inside the sparse
+            # coordinate-descent path), copy_X=False means no fold ever
+            # materialises its own copy.
+            self.fs_encv = ElasticNetCV(
+                l1_ratio=[0.1, 0.5, 0.7, 0.9, 0.95, 0.99, 1],
+                precompute=False,
+                selection="random",
+                cv=KFold(n_splits=5, shuffle=True, random_state=0),
+                n_jobs=-1,
+                copy_X=False,
+                random_state=0,
+            )
+        self.final_ridge = EigenRidgeCV(np.linspace(0.1, 10, 100))
 
     def remove_low_freq_subgraphs(self, threshold: Union[float, int] = 1) -> int:
         """Amend the smiles hashes to remove those that only occur once in the training data.
@@ -101,8 +321,10 @@ class LinearECFPModel:
         if isinstance(threshold, float):
             threshold = int(np.floor(threshold * self.train_fps.shape[0]))
 
-        has_group = self.train_fps > 0
-        include_group = has_group.sum(axis=0) > threshold
+        # The per-column nonzero counts are just the differences of the CSC
+        # column pointers, so no comparison matrix is ever materialised.
+        counts = np.diff(self.train_fps.tocsc().indptr)
+        include_group = counts > threshold
 
         self.smiles_hashes.hash_df["selected"] = list(include_group)
         self.smiles_hashes.hash_df["above_threshold_occurrence"] = list(include_group)
@@ -112,7 +334,7 @@ class LinearECFPModel:
 
         return (~include_group).sum()
 
-    def _apply_low_freq_filter(self, fps: np.ndarray) -> np.ndarray:
+    def _apply_low_freq_filter(self, fps: sparse.spmatrix) -> sparse.spmatrix:
         """Apply the low frequency subgraph filter to given fingerprints."""
         return fps[
             :, self.smiles_hashes.hash_df["above_threshold_occurrence"].to_numpy()
@@ -125,9 +347,25 @@ class LinearECFPModel:
             The results of the Elastic Net search.
 
         """
+        # Scale once, up front: the pipeline equivalent would re-fit the
+        # scaler and re-transform the training matrix at every stage.
+        self.train_scaled = self.scaler.fit_transform(self.train_fps_filtered)
+
         self.selector = SelectFromModel(self.fs_encv, threshold=1e-5)
-        self.model = make_pipeline(self.scaler, self.selector, self.final_ridge)
-        self.model.fit(self.train_fps_filtered, self.train_targets)
+        self.selector.fit(self.train_scaled, self.train_targets)
+        # Integer column indices: CSR fancy indexing has a faster path for
+        # these than for boolean masks, and they are computed just once here
+        # rather than on every selector.transform call.
+        self.sel_idx = self.selector.get_support(indices=True)
+
+        self.final_ridge.fit(self.train_scaled[:, self.sel_idx], self.train_targets)
+        self.model = self.final_ridge
+        self.fast_predictor = FastPredictor(
+            self.final_ridge.coef_,
+            self.final_ridge.intercept_,
+            1.0 / self.scaler.scale_[self.sel_idx],
+            self.sel_idx,
+        )
 
         support = self.selector.get_support()
         end_model_selector = SelectFromModel(self.final_ridge, threshold=1e-5, prefit=True)
@@ -162,7 +400,7 @@ class LinearECFPModel:
 
         return results
 
-    def evaluate(self, fps: np.ndarray, targets: np.ndarray) -> Dict[str, float]:
+    def evaluate(self, fps: sparse.spmatrix, targets: np.ndarray) -> Dict[str, float]:
         """Get the RMSE and R^2 values for a set of fingerprints and target values."""
         predictions = self.predict(fps)
         flat_targets = targets
@@ -170,10 +408,21 @@ class LinearECFPModel:
         r2 = r2_score(flat_targets, predictions)
         return {"rmse": rmse, "r2": r2}
 
-    def predict(self, fps: np.ndarray) -> np.ndarray:
+    def _scale_selected(self, fps: sparse.spmatrix) -> sparse.spmatrix:
+        """Slice out the selected columns, then apply the fitted scaling.
+
+        Slicing first keeps the scaling to the handful of selected columns
+        rather than the full fingerprint width.
+        """
+        selected = fps[:, self.sel_idx]
+        return selected.multiply(1.0 / self.scaler.scale_[self.sel_idx]).tocsr()
+
+    def predict(self, fps: sparse.spmatrix) -> np.ndarray:
         """Get an array of predictions."""
         try:
-            return self.model.predict(self._apply_low_freq_filter(fps)).flatten()
+            return self.fast_predictor.predict(
+                self._apply_low_freq_filter(fps)
+            ).flatten()
         except AttributeError:
             raise ValueError("Must first fit model.")
 
@@ -184,9 +433,9 @@ class ProbECFPModel(LinearECFPModel):
     def __init__(
         self,
         smiles_hashes: SMILESHashes,
-        train_fps: np.ndarray,
+        train_fps: Union[np.ndarray, sparse.spmatrix],
         train_targets: np.ndarray,
-        test_fps: np.ndarray,
+        test_fps: Union[np.ndarray, sparse.spmatrix],
         test_targets: np.ndarray,
     ) -> None:
         """Initialize smiles hash dataframe."""
@@ -197,20 +446,35 @@ class ProbECFPModel(LinearECFPModel):
 
     def ridge_model_train_test(self) -> Dict[str, Any]:
         """Train and test the Bayesian ridge regression model."""
-        self.model = make_pipeline(self.scaler, self.selector, self.ridge)
-        self.model.fit(self.train_fps_filtered, self.train_targets)
+        # The scaler and selector were already fitted during
+        # elastic_feature_select; reuse the cached scaled matrix and the
+        # selected column indices rather than re-fitting a pipeline.
+        # BayesianRidge requires dense input, but the matrices are narrow
+        # enough after selection that densifying them is cheap.
+        train_selected = self.train_scaled[:, self.sel_idx].toarray()
+        self.ridge.fit(train_selected, self.train_targets)
+        self.model = self.ridge
+        self.fast_predictor = FastPredictor(
+            self.ridge.coef_,
+            self.ridge.intercept_,
+            1.0 / self.scaler.scale_[self.sel_idx],
+            self.sel_idx,
+        )
 
-        self.test_predictions, self.test_stds = self.model.predict(
-            self.test_fps_filtered, {"return_std": True}
+        self.test_predictions, self.test_stds = self.ridge.predict(
+            self._scale_selected(self.test_fps_filtered).toarray(), return_std=True
         )
 
+        train_rmse = mean_squared_error(
+            self.train_targets, self.ridge.predict(train_selected), squared=False
+        )
         test_rmse = mean_squared_error(
             self.test_targets, self.test_predictions, squared=False
         )
         test_nll = nll(self.test_predictions, self.test_stds, self.test_targets)
 
         self.results = dict(
-            best_rmse=-self.ridge.best_score_,
+            train_rmse=train_rmse,
             alpha=self.ridge.alpha_,
             coefs=self.ridge.coef_,
             test_rmse=test_rmse,
@@ -218,7 +482,7 @@ class ProbECFPModel(LinearECFPModel):
             test_nll=test_nll,
         )
         self.smiles_hashes.set_weights(
-            self.results.coefs,
-            self.results.get_unnormed_contribs(self.scaler, self.selector),
+            self.results["coefs"],
+            get_unnormed_contribs(self.results["coefs"], self.scaler, self.selector),
         )
         return self.results
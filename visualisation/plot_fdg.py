@@ -1,7 +1,7 @@
 """Plot force-directed layout of molecules."""
-import re
 
 DO_PY_FA = False
+USE_CUGRAPH = False
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,12 +11,22 @@ from pathlib import Path
 from scipy.stats import norm
 if DO_PY_FA:
     from fa2 import ForceAtlas2
+if USE_CUGRAPH:
+    import cudf
+    import cugraph
+
+# Rasterise the panels with datashader instead of drawing one matplotlib
+# artist per molecule; worthwhile once the dataset reaches thousands of rows.
+USE_DATASHADER = False
+if USE_DATASHADER:
+    import datashader as ds
+    from datashader import transfer_functions as tf
 
 CACHE_POSITIONS = False
 COLOUR_COUNTERION = True
 HERE = Path(__file__).parent
 
-if DO_PY_FA:
+if DO_PY_FA or USE_CUGRAPH:
     kernel_df = pd.read_csv(HERE / "full_kernel.csv")
 else:
     kernel_df = pd.read_csv(HERE / "fdg.csv")
@@ -32,33 +42,84 @@ nist_pred_df["Above 95% CI"].sum() / len(nist_pred_df["Above 95% CI"])
 
 clusters_df = pd.read_csv(HERE / "clusters.csv")
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Return codes for _classify_counterion; _SLICE carries a span into the
+# SMILES string, the rest map to fixed labels.
+_NONIONIC = 0
+_ZWITTERIONIC = 1
+_QUAT = 2
+_SLICE = 3
+
+_COUNTERION_LABELS = {
+    _NONIONIC: "Nonionic",
+    _ZWITTERIONIC: "Zwitterionic",
+    _QUAT: "Quat",
+}
+
+def _classify_counterion(smiles):
+    """Classify the counterion with a plain left-to-right string scan.
+
+    Returns ``(code, start, end)``: for ``_SLICE`` the span picks the
+    counterion out of the SMILES string, otherwise the span is unused.
+    The scan replaces the regex engine entirely, and only uses string
+    operations that numba's nopython mode supports.
+    """
+    dot = smiles.find(".")
+    if dot == -1:
+        if "+" in smiles and "-" in smiles:
+            return (_ZWITTERIONIC, 0, 0)
+        return (_NONIONIC, 0, 0)
+
+    start = dot + 1
+    counterion = smiles[start:]
+    if counterion.find(".") != -1:
+        # Multivalent: a bracketed, charged unit repeated across "."
+        # separators, e.g. "[Cl-].[Cl-]".
+        prev_start = -1
+        prev_end = -1
+        prev_charged = False
+        part_start = 0
+        while True:
+            part_end = counterion.find(".", part_start)
+            if part_end == -1:
+                part_end = len(counterion)
+            if (
+                prev_charged
+                and counterion[part_start:part_end] == counterion[prev_start:prev_end]
+            ):
+                return (_SLICE, start + prev_start, start + prev_end)
+            part = counterion[part_start:part_end]
+            prev_charged = (
+                len(part) >= 4
+                and part[0] == "["
+                and part[len(part) - 1] == "]"
+                and (part[len(part) - 2] == "+" or part[len(part) - 2] == "-")
+            )
+            prev_start = part_start
+            prev_end = part_end
+            if part_end == len(counterion):
+                break
+            part_start = part_end + 1
+        # No repeated unit: take everything after the last ".".
+        last = counterion.rfind(".")
+        return (_SLICE, start + last + 1, start + len(counterion))
+    if "C[N+]" in counterion or "CC" in counterion:
+        return (_QUAT, 0, 0)
+    return (_SLICE, start, start + len(counterion))
+
+if njit is not None:
+    _classify_counterion = njit(cache=True)(_classify_counterion)
+
 def get_counterion(smiles: str) -> str:
     """Get the counterion for a smiles string"""
-    pattern = r"\.(?P<counterion>\S+)"
-    match = re.search(pattern, smiles)
-    if match:
-        counterion = match.group("counterion")
-        if "." in counterion:
-            multivalent_patt = r"(\[\S+[\+-]\])(\.\1)+"
-            mulit_match = re.search(multivalent_patt, counterion)
-            if mulit_match:
-                return mulit_match.group(1)
-            else:
-                last_bit_patt = r"\S+\.(\S+)$"
-                last_bit_match = re.search(last_bit_patt, counterion)
-                if last_bit_match:
-                    return last_bit_match.group(1)
-                else:
-                    raise ValueError("No match!")
-        elif "C[N+]" in counterion or "CC" in counterion:
-            return "Quat"
-        else:
-            return counterion
-    else:
-        if "+" in smiles and "-" in smiles:
-            return "Zwitterionic"
-        else:
-            return "Nonionic"
+    code, span_start, span_end = _classify_counterion(smiles)
+    if code == _SLICE:
+        return smiles[span_start:span_end]
+    return _COUNTERION_LABELS[code]
 
 def add_cols(df: pd.DataFrame):
     df["Counterion"] = df["SMILES"].apply(get_counterion)
@@ -66,11 +127,57 @@ def add_cols(df: pd.DataFrame):
 
 add_cols(kernel_df)
 kernel_df = kernel_df.merge(nist_pred_df, on="Molecule name", how="left")
-kernel_df["Above 95% CI"] = kernel_df["Above 95% CI"].apply(lambda x: x is True)
-kernel_df["Cluster"] = clusters_df["cluster"]
-kernel_df["Cluster"] = pd.Categorical(kernel_df["Cluster"])
+# Molecules without a NIST prediction get NaN from the left merge.
+kernel_df["Above 95% CI"] = kernel_df["Above 95% CI"].fillna(False).astype(bool)
+# clusters.csv covers fewer molecules than kernel_df, so the cluster column
+# must be reindexed (padding NaN) rather than assigned positionally.
+kernel_df["Cluster"] = pd.Categorical(clusters_df["cluster"].reindex(kernel_df.index))
 
-if DO_PY_FA:
+def cugraph_layout(kernel_mat: np.ndarray, n_neighbours: int = 10) -> np.ndarray:
+    """Compute the ForceAtlas2 layout on the GPU via cuGraph.
+
+    The dense kernel matrix is thresholded to each node's nearest neighbours
+    so that the graph handed to cuGraph stays sparse.
+    """
+    n_nodes = kernel_mat.shape[0]
+    kernel = kernel_mat.astype(np.float64, copy=True)
+    np.fill_diagonal(kernel, -np.inf)
+    neighbour_idxs = np.argpartition(kernel, -n_neighbours, axis=1)[:, -n_neighbours:]
+
+    sources = np.repeat(np.arange(n_nodes), n_neighbours)
+    dests = neighbour_idxs.ravel()
+    edges = cudf.DataFrame(
+        {"source": sources, "destination": dests, "weight": kernel[sources, dests]}
+    )
+
+    graph = cugraph.Graph()
+    graph.from_cudf_edgelist(
+        edges, source="source", destination="destination", edge_attr="weight"
+    )
+    layout = cugraph.force_atlas2(
+        graph,
+        max_iter=5000,
+        barnes_hut_theta=1.2,
+        scaling_ratio=5.0,
+        gravity=5.0,
+        edge_weight_influence=10.0,
+    )
+    layout = layout.to_pandas().sort_values("vertex")
+    return layout[["x", "y"]].to_numpy()
+
+if USE_CUGRAPH:
+    if CACHE_POSITIONS:
+        try:
+            positions = np.load(HERE / "positions.npy")
+        except FileNotFoundError:
+            positions = cugraph_layout(kernel_mat)
+            np.save(HERE / "positions.npy", positions)
+    else:
+        positions = cugraph_layout(kernel_mat)
+
+    kernel_df["x"] = positions[:, 0]
+    kernel_df["y"] = positions[:, 1]
+elif DO_PY_FA:
     forceatlas2 = ForceAtlas2(
         # Behavior alternatives
         outboundAttractionDistribution=False, # Dissuade hubs
@@ -116,53 +223,78 @@ class_order = list(all_classes)
 order = counterion_order if COLOUR_COUNTERION else class_order
 
 fig, axs = plt.subplots(1, 2, sharex=True, sharey=True, subplot_kw=dict(aspect="equal"))
-sns.scatterplot(
-    to_plot,
-    x="x",
-    y="y",
-    style=style,
-    # size="Source",
-    hue=style,
-    # size_order=["NIST", "Qin"],
-    hue_order=order,
-    style_order=order,
-    ax=axs[0],
-    legend=True
-)
-
-just_qin = to_plot[to_plot["Source"] == "Qin"]
-
-qin_counterion_counts = just_qin["Counterion"].value_counts()
-include_kde = just_qin["Counterion"].apply(lambda x: qin_counterion_counts[x] > 2)
-
-sns.kdeplot(
-    just_qin[include_kde],
-    x="x",
-    y="y",
-    hue=style,
-    hue_order=order,
-    ax=axs[1],
-    fill=True,
-    # bw_adjust=0.9,
-    thresh=0.2,
-    legend=False
-)
-sns.scatterplot(
-    to_plot[to_plot["Above 95% CI"]],
-    x="x",
-    y="y",
-    style=style,
-    hue=style,
-    # size="Source",
-    # size_order=["NIST", "Qin"],
-    hue_order=order,
-    style_order=order,
-    ax=axs[1],
-    legend=False,
-    zorder=10
-)
-
-sns.move_legend(axs[0], "upper center", bbox_to_anchor=(1.1,0), frameon=False, ncol=5)
+
+if USE_DATASHADER:
+    x_range = (to_plot["x"].min(), to_plot["x"].max())
+    y_range = (to_plot["y"].min(), to_plot["y"].max())
+    extent = (*x_range, *y_range)
+    canvas = ds.Canvas(plot_width=800, plot_height=800, x_range=x_range, y_range=y_range)
+
+    shade_df = to_plot.copy()
+    shade_df[style] = shade_df[style].astype("category")
+
+    scatter_agg = canvas.points(shade_df, "x", "y", ds.by(style, ds.count()))
+    scatter_img = tf.dynspread(tf.shade(scatter_agg))
+    axs[0].imshow(scatter_img.to_pil(), extent=extent)
+
+    # A spread raster of the Qin points stands in for the per-hue KDE.
+    just_qin = shade_df[shade_df["Source"] == "Qin"]
+    density_agg = canvas.points(just_qin, "x", "y", ds.by(style, ds.count()))
+    density_img = tf.spread(tf.shade(density_agg, how="eq_hist"), px=5, shape="circle")
+    axs[1].imshow(density_img.to_pil(), extent=extent)
+
+    above_ci = shade_df[shade_df["Above 95% CI"]]
+    above_agg = canvas.points(above_ci, "x", "y", ds.by(style, ds.count()))
+    above_img = tf.dynspread(tf.shade(above_agg))
+    axs[1].imshow(above_img.to_pil(), extent=extent, zorder=10)
+else:
+    sns.scatterplot(
+        to_plot,
+        x="x",
+        y="y",
+        style=style,
+        # size="Source",
+        hue=style,
+        # size_order=["NIST", "Qin"],
+        hue_order=order,
+        style_order=order,
+        ax=axs[0],
+        legend=True
+    )
+
+    just_qin = to_plot[to_plot["Source"] == "Qin"]
+
+    qin_counterion_counts = just_qin["Counterion"].value_counts()
+    include_kde = just_qin["Counterion"].apply(lambda x: qin_counterion_counts[x] > 2)
+
+    sns.kdeplot(
+        just_qin[include_kde],
+        x="x",
+        y="y",
+        hue=style,
+        hue_order=order,
+        ax=axs[1],
+        fill=True,
+        # bw_adjust=0.9,
+        thresh=0.2,
+        legend=False
+    )
+    sns.scatterplot(
+        to_plot[to_plot["Above 95% CI"]],
+        x="x",
+        y="y",
+        style=style,
+        hue=style,
+        # size="Source",
+        # size_order=["NIST", "Qin"],
+        hue_order=order,
+        style_order=order,
+        ax=axs[1],
+        legend=False,
+        zorder=10
+    )
+
+    sns.move_legend(axs[0], "upper center", bbox_to_anchor=(1.1,0), frameon=False, ncol=5)
 for ax in axs:
     ax.set(xlabel="", ylabel="", xticklabels=[], yticklabels=[])
 # plt.tight_layout()